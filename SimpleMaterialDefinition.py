@@ -2,7 +2,13 @@ import bpy.types
 
 
 class SimpleMaterialDefinition:
-    def __init__(self, diffuseTexture: bpy.types.Image, normalTexture: bpy.types.Image, metallicTexture: bpy.types.Image):
+    def __init__(self, diffuseTexture: bpy.types.Image, normalTexture: bpy.types.Image, metallicTexture: bpy.types.Image,
+                 roughnessTexture: bpy.types.Image = None, emissionTexture: bpy.types.Image = None,
+                 alphaTexture: bpy.types.Image = None, aoTexture: bpy.types.Image = None):
         self.diffuseTexture = diffuseTexture
         self.normalTexture = normalTexture
         self.metallicTexture = metallicTexture
+        self.roughnessTexture = roughnessTexture
+        self.emissionTexture = emissionTexture
+        self.alphaTexture = alphaTexture
+        self.aoTexture = aoTexture
@@ -1,6 +1,85 @@
+from typing import List
 import bpy
 
 
+def modifier_stack_key(obj: bpy.types.Object):
+    # Objects sharing mesh data and an identical modifier stack evaluate to the same mesh, so they can share the result.
+    # Anything pointing at another ID (objects, collections, textures...) can depend on where the object is, and
+    # geometry nodes keep their inputs in ID properties, so those stacks are never shared.
+    unique = False
+    stack = []
+    for modifier in obj.modifiers:
+        if modifier.type == "NODES":
+            unique = True
+        properties = []
+        for prop in modifier.bl_rna.properties:
+            if prop.identifier == "rna_type":
+                continue
+            value = getattr(modifier, prop.identifier)
+            if prop.type == "COLLECTION":
+                unique = True  # Can't compare these cheaply, don't share the result
+                continue
+            if prop.type == "POINTER" and isinstance(value, bpy.types.ID):
+                unique = True
+            if getattr(prop, "is_array", False):
+                value = tuple(value)
+            properties.append(f"{prop.identifier}={value}")
+        stack.append((modifier.type, tuple(properties)))
+    key = (obj.data.name, tuple(stack))
+    if unique:
+        key += (obj.name,)
+    return key
+
+
+# Modifiers that own simulation or particle data, clearing the stack would throw that away.
+PHYSICS_MODIFIERS = {"PARTICLE_SYSTEM", "CLOTH", "SOFT_BODY", "COLLISION", "FLUID", "DYNAMIC_PAINT"}
+
+
+def can_apply_evaluated(obj: bpy.types.Object):
+    if obj.type != "MESH" or len(obj.modifiers) == 0:
+        return False
+    if obj.data.shape_keys is not None:
+        return False  # Evaluated meshes don't keep shape keys, modifier_apply reports these properly
+    for modifier in obj.modifiers:
+        if modifier.type in PHYSICS_MODIFIERS:
+            return False
+        if not modifier.show_viewport:
+            return False  # modifier_apply skips disabled modifiers, so the result would differ
+    return True
+
+
+def apply_modifiers_evaluated(context, objects: List[bpy.types.Object]):
+    depsgraph = context.evaluated_depsgraph_get()
+
+    # Build every mesh first - swapping data in tags the depsgraph, which would invalidate the evaluated objects.
+    new_meshes = {}
+    object_keys = []
+    for obj in objects:
+        key = modifier_stack_key(obj)
+        object_keys.append((obj, key))
+        if key not in new_meshes:
+            evaluated_object = obj.evaluated_get(depsgraph)
+            new_meshes[key] = bpy.data.meshes.new_from_object(
+                evaluated_object, preserve_all_data_layers=True, depsgraph=depsgraph)
+
+    old_meshes = {}
+    for obj, key in object_keys:
+        old_meshes[obj.data.name] = obj.data
+        obj.data = new_meshes[key]
+        obj.modifiers.clear()
+
+    for old_name, old_mesh in old_meshes.items():
+        if old_mesh.users != 0:
+            continue
+        bpy.data.meshes.remove(old_mesh)
+        for key, new_mesh in new_meshes.items():
+            if key[0] == old_name:
+                new_mesh.name = old_name
+                break
+
+    return len(new_meshes)
+
+
 class ApplyOperatorsOperator(bpy.types.Operator):
     """Apply operators on selected objects."""
     bl_idname = "dusty.applyoperators"
@@ -9,15 +88,26 @@ class ApplyOperatorsOperator(bpy.types.Operator):
 
     def execute(self, context):        # execute() is called when running the operator.
         selected_objects = bpy.context.selected_objects
+        fast_objects = []
+        fallback_objects = []
         for selected_object in selected_objects:
+            if can_apply_evaluated(selected_object):
+                fast_objects.append(selected_object)
+            elif len(selected_object.modifiers) > 0:
+                fallback_objects.append(selected_object)
+
+        mesh_count = 0
+        if len(fast_objects) > 0:
+            mesh_count = apply_modifiers_evaluated(context, fast_objects)
+
+        for selected_object in fallback_objects:
             bpy.context.view_layer.objects.active = selected_object
-            print(selected_object.name)
             new_context = bpy.context.copy()
             new_context['selected_objects'] = [selected_object]
             new_context['active_object'] = selected_object
             for modifier in selected_object.modifiers:
-                print(modifier.name)
                 bpy.ops.object.modifier_apply(new_context, "INVOKE_DEFAULT", False, modifier=modifier.name)
 
-        self.report({'INFO'}, f"Applied operators.")
+        self.report({'INFO'}, f"Applied operators on {len(fast_objects)} objects ({mesh_count} meshes), "
+                              f"{len(fallback_objects)} objects applied one modifier at a time.")
         return {'FINISHED'}            # Lets Blender know the operator finished successfully.
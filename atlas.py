@@ -1,100 +1,148 @@
 import bpy
-from typing import List, Dict
+from typing import List, Dict, Tuple, Optional, Set
 import math
 import shutil
 import os
 import logging
 import re
 from . import SimpleMaterialDefinition
+from . import node_graph
+from .material_index import build_material_loop_index, read_uvs, write_uvs
 from PIL import Image
 
 
 log = logging.getLogger("DustyAtlas")
 
 
-def get_texture_from_normal_node(node: bpy.types.ShaderNodeNormalMap):
-    if node.type != "NORMAL_MAP":
-        raise Exception("Node is not a normal map node.")
-    if node.uv_map != '':
-        raise Exception("Normal map node has a UV map set, which would break when atlasing without extra support.")
-    color_input = node.inputs[1]
-    if not color_input.is_linked:
+def get_channel_texture(mat: bpy.types.Material, analysis: node_graph.NodeGraphAnalysis, channel: str,
+                        required: bool = True):
+    if not analysis.is_linked(channel):
         return None
-    return get_texture_from_image_node(color_input.links[0].from_socket.node)
-
-
-def get_texture_from_image_node(node: bpy.types.ShaderNodeTexImage):
-    if node.type != "TEX_IMAGE":
-        raise Exception("Node is not an image texture node.")
-    return node.image
-
-
-def get_texture_from_bw_node(node: bpy.types.ShaderNodeRGBToBW):
-    if type(node) is not bpy.types.ShaderNodeRGBToBW:
-        raise Exception("Node is not an RGB to BW node.")
-    color_input = node.inputs[0]
-    if not color_input.is_linked:
-        raise Exception("RGB to BW node is not linked")
-    return get_texture_from_image_node(color_input.links[0].from_socket.node)
+    path = analysis.paths[channel]
+    for node in path:
+        if node.type == "NORMAL_MAP" and node.uv_map != '':
+            raise Exception("Normal map node has a UV map set, which would break when atlasing without extra support.")
+    if path[-1].type in node_graph.PASSTHROUGH_INPUTS:
+        return None  # Nothing connected further upstream
+    if path[-1].type != "TEX_IMAGE":
+        if not required:
+            return None  # Extra channels are carried along when possible, but don't block atlasing
+        raise Exception(f"Material '{mat.name}': {channel} input isn't driven by an image texture (stopped at '{path[-1].name}').")
+    return analysis.textures[channel]
 
 
 def get_texture_set_for_material(mat: bpy.types.Material):
     if not mat.use_nodes:
         raise Exception(f"Material '{mat.name}' doesn't use nodes - nodes are required.")
 
-    output_node = None
-    for node in mat.node_tree.nodes:
-        if node.type == "OUTPUT_MATERIAL":
-            output_node = node
-            break
-    if output_node is None:
+    analysis = node_graph.analyze_node_tree(mat.node_tree)
+    if analysis.output_node is None:
         raise Exception(f"Material '{mat.name}' lacks a Material Output node.")
-    if not output_node.inputs[0].is_linked:
+    if analysis.surface_node is None:
         raise Exception(f"Material '{mat.name}' doesn't have a Surface output set up.")
-
-    surface_node: bpy.types.Node = output_node.inputs[0].links[0].from_socket.node
-    color_input = None
-    normal_input = None
-    metallic_input = None
-    for nodeInput in surface_node.inputs:
-        if nodeInput.name == "Color" or nodeInput.name == "Base Color":
-            color_input = nodeInput
-        elif nodeInput.name == "Normal":
-            normal_input = nodeInput
-        elif nodeInput.name == "Metallic":
-            metallic_input = nodeInput
-        if color_input is not None and normal_input is not None and metallic_input is not None:
-            break
-    if color_input is None:
+    if "base_color" not in analysis.sockets:
         raise Exception(f"Material '{mat.name}': Failed to find a (Base) Color input on the surface node.")
-
-    color_texture = None
-    if not color_input.is_linked:
+    if not analysis.is_linked("base_color"):
         raise NotImplementedError()
-    else:
-        color_texture = get_texture_from_image_node(color_input.links[0].from_socket.node)
-
-    normal_texture = None
-    if normal_input is not None and normal_input.is_linked:
-        normal_texture = get_texture_from_normal_node(normal_input.links[0].from_socket.node)
-
-    metallic_texture = None
-    if metallic_input is not None and metallic_input.is_linked:
-        metallic_texture = get_texture_from_bw_node(metallic_input.links[0].from_socket.node)
-
-    return SimpleMaterialDefinition.SimpleMaterialDefinition(color_texture, normal_texture, metallic_texture)
-
 
-def collate_textures(tile_max_y, tile_max_x, tile_map, materials, directory, prefix):
-    output_diffuse = []
-    output_normal = []
-    output_metallic = []
-    for y in range(0, tile_max_y):
-        for x in range(0, tile_max_x):
-            if tile_map[x][y] is not None:
-                output_diffuse.append(materials[tile_map[x][y]].diffuseTexture)
-                output_normal.append(materials[tile_map[x][y]].normalTexture)
-                output_metallic.append(materials[tile_map[x][y]].metallicTexture)
+    return SimpleMaterialDefinition.SimpleMaterialDefinition(
+        get_channel_texture(mat, analysis, "base_color"),
+        get_channel_texture(mat, analysis, "normal"),
+        get_channel_texture(mat, analysis, "metallic"),
+        roughnessTexture=get_channel_texture(mat, analysis, "roughness", False),
+        emissionTexture=get_channel_texture(mat, analysis, "emission", False),
+        alphaTexture=get_channel_texture(mat, analysis, "alpha", False),
+        aoTexture=get_channel_texture(mat, analysis, "ao", False))
+
+
+class TilePlacement:
+    def __init__(self, tile_x: int, tile_y: int, cell_x: int = 0, cell_y: int = 0, cells: int = 1):
+        self.tile_x = tile_x
+        self.tile_y = tile_y
+        self.cell_x = cell_x
+        self.cell_y = cell_y
+        self.cells = cells
+
+    @property
+    def udim(self):
+        return 1001 + self.tile_x + (self.tile_y * 10)
+
+    @property
+    def scale(self):
+        return 1 / self.cells
+
+    @property
+    def offset(self):
+        return [self.tile_x + (self.cell_x * self.scale), self.tile_y + (self.cell_y * self.scale)]
+
+
+def layout_udims_grid(materials: Dict[str, SimpleMaterialDefinition.SimpleMaterialDefinition], tile_max_x: int):
+    # One material per tile, filled row by row in the order they were given.
+    placements = {}
+    for material_index, material_id in enumerate(materials.keys()):
+        placements[material_id] = TilePlacement(material_index % tile_max_x, material_index // tile_max_x)
+    return placements
+
+
+def pick_sub_grid_cells(material_count: int, max_cells: int):
+    # A shared tile is always allocated as a full sub-grid, so empty cells cost texels. Only share when that doesn't
+    # use more texels than a tile per material, preferring fewer tiles when it's a tie.
+    best_cells = 1
+    best_cost = (material_count, material_count)
+    for cells in range(2, min(max_cells, math.ceil(math.sqrt(material_count))) + 1):
+        tile_count = math.ceil(material_count / (cells * cells))
+        cost = (tile_count * cells * cells, tile_count)
+        if cost < best_cost:
+            best_cells = cells
+            best_cost = cost
+    return best_cells
+
+
+def layout_udims_by_size(materials: Dict[str, SimpleMaterialDefinition.SimpleMaterialDefinition], tile_max_x: int,
+                         share_tiles: bool, exclusive_materials: Set[str]):
+    # Materials are grouped by the resolution of their diffuse texture, largest first, and every group starts on a
+    # new row. Groups smaller than the largest one can share a tile, laid out as a sub-grid sized to the group.
+    # Materials listed in exclusive_materials always get a tile of their own.
+    groups = {}
+    for material_id, definition in materials.items():
+        size = (max(definition.diffuseTexture.size[0], 1), max(definition.diffuseTexture.size[1], 1))
+        group = (size, share_tiles and material_id not in exclusive_materials)
+        if group not in groups:
+            groups[group] = []
+        groups[group].append(material_id)
+    group_keys = sorted(groups.keys(), key=lambda x: (x[0][0] * x[0][1], x[1]), reverse=True)
+    tile_size_x, tile_size_y = group_keys[0][0]
+
+    placements = {}
+    row = 0
+    for group in group_keys:
+        size, shareable = group
+        max_cells = 1
+        if shareable:
+            max_cells = max(1, min(tile_size_x // size[0], tile_size_y // size[1]))
+        cells = pick_sub_grid_cells(len(groups[group]), max_cells)
+        materials_per_tile = cells * cells
+        for material_index, material_id in enumerate(groups[group]):
+            tile_index, cell_index = divmod(material_index, materials_per_tile)
+            placements[material_id] = TilePlacement(tile_index % tile_max_x, row + (tile_index // tile_max_x),
+                                                    cell_index % cells, cell_index // cells, cells)
+        tile_count = math.ceil(len(groups[group]) / materials_per_tile)
+        row += math.ceil(tile_count / tile_max_x)
+    return placements
+
+
+def collate_textures(placements: Dict[str, TilePlacement], materials, directory, prefix):
+    output_diffuse = {}
+    output_normal = {}
+    output_metallic = {}
+    for material_id, placement in sorted(placements.items(), key=lambda x: x[1].udim):
+        if placement.udim not in output_diffuse:
+            output_diffuse[placement.udim] = []
+            output_normal[placement.udim] = []
+            output_metallic[placement.udim] = []
+        output_diffuse[placement.udim].append((placement, materials[material_id].diffuseTexture))
+        output_normal[placement.udim].append((placement, materials[material_id].normalTexture))
+        output_metallic[placement.udim].append((placement, materials[material_id].metallicTexture))
     return \
         generate_udim_texture(f"{prefix}.Diffuse", directory, output_diffuse), \
         generate_udim_texture(f"{prefix}.Normal", directory, output_normal), \
@@ -104,79 +152,104 @@ def collate_textures(tile_max_y, tile_max_x, tile_map, materials, directory, pre
 def merge_textures_udim_style(materials: Dict[str, SimpleMaterialDefinition.SimpleMaterialDefinition],
                               meshes: List[bpy.types.Mesh],
                               fileprefix: str,
-                              directory: str):
+                              directory: str,
+                              layout: str = "GRID",
+                              share_tiles: bool = True,
+                              exclusive_materials: Set[str] = frozenset()):
     # UDIM style - each material gets placed on a grid, and UVs for each polygon gets offset to account for it.
     # + Simple, fast
     # - Waste of texture space since unused material space is left in
+    # The SIZE layout reduces the waste for mixed resolutions by letting small materials share a tile.
     tile_max_x = 10
-    tile_max_y = math.ceil(len(materials)/tile_max_x)
-    material_ids = [x for x in materials.keys()]
-
-    # Tile the materials into UDIMs
-    tile_map = {}
-    for x in range(0, tile_max_x):
-        tile_map[x] = {}
-        for y in range(0, tile_max_y):
-            tile_map[x][y] = None
-
-    tile_map_lookup = {}
-    for y in range(0, tile_max_y):
-        for x in range(0, tile_max_x):
-            material_index = (y * tile_max_x) + x
-            if material_index < len(material_ids):
-                tile_map[x][y] = material_ids[material_index]
-                tile_map_lookup[material_ids[material_index]] = [x, y]
+
+    # Read the UVs of the loops that use one of the atlased materials up front, the layout depends on their range
+    loop_index = build_material_loop_index(meshes, materials.keys())
+    mesh_uvs = [read_uvs(entry.mesh) for entry in loop_index.entries]
+    # Materials with UVs outside of 0-1 would sample their neighbours in a shared tile
+    exclusive_materials = set(exclusive_materials)
+    for entry, uvs in zip(loop_index.entries, mesh_uvs):
+        for material_name, loops in entry.loops.items():
+            material_uvs = uvs[loops]
+            if material_uvs.min() < 0 or material_uvs.max() > 1:
+                exclusive_materials.add(material_name)
+
+    if layout == "SIZE":
+        placements = layout_udims_by_size(materials, tile_max_x, share_tiles, exclusive_materials)
+    else:
+        placements = layout_udims_grid(materials, tile_max_x)
 
     # Map the UVs onto the UDIMs
-    for mesh in meshes:
-        if len(mesh.materials) == 0:
-            continue  # Skip if no material slots exist on the mesh
-        if len(mesh.uv_layers) == 0:
-            raise Exception("Missing UV map!")
-        for polygon in mesh.polygons:
-            polygon_material_name = mesh.materials[polygon.material_index].name
-            if polygon_material_name not in tile_map_lookup.keys():
-                continue
-            for loop_index in polygon.loop_indices:
-                loop_uv = mesh.uv_layers[0].data[loop_index].uv
-                mesh.uv_layers[0].data[loop_index].uv[0] = loop_uv[0] + tile_map_lookup[polygon_material_name][0]
-                mesh.uv_layers[0].data[loop_index].uv[1] = loop_uv[1] + tile_map_lookup[polygon_material_name][1]
+    for entry, uvs in zip(loop_index.entries, mesh_uvs):
+        for material_name, loops in entry.loops.items():
+            placement = placements[material_name]
+            if placement.cells == 1:
+                uvs[loops] += placement.offset
+            else:
+                uvs[loops] = (uvs[loops] * placement.scale) + placement.offset
+        write_uvs(entry.mesh, uvs)
 
     # Generate two UDIM textures
     diffuse_texture, normal_texture, metallic_texture = \
-        collate_textures(tile_max_y, tile_max_x, tile_map, materials, directory, fileprefix)
+        collate_textures(placements, materials, directory, fileprefix)
     normal_texture.colorspace_settings.name = "Non-Color"
     normal_texture.colorspace_settings.is_data = True
 
     return diffuse_texture, normal_texture, metallic_texture
 
 
-def generate_udim_texture(name: str, path: str, textures: List[bpy.types.Image]):
-    if len(textures) == 1:
+def compose_tile(textures: List[Tuple[TilePlacement, Optional[bpy.types.Image]]]):
+    # Several materials sharing a tile - paste them into a sub-grid, flipping V since PIL has its origin at the top.
+    cells = textures[0][0].cells
+    images = {}
+    cell_size_x = 1
+    cell_size_y = 1
+    for placement, texture in textures:
+        if texture is None:
+            continue
+        im = Image.open(bpy.path.abspath(texture.filepath)).convert("RGBA")
+        images[(placement.cell_x, placement.cell_y)] = im
+        cell_size_x = max(cell_size_x, im.width)
+        cell_size_y = max(cell_size_y, im.height)
+
+    output_image = Image.new("RGBA", (cell_size_x * cells, cell_size_y * cells), (0, 0, 0, 0))
+    for placement, texture in textures:
+        im = images.get((placement.cell_x, placement.cell_y))
+        if im is None:
+            im = Image.new("RGBA", (cell_size_x, cell_size_y), (0x7F, 0x7F, 0xFF, 0xFF))
+        elif im.width != cell_size_x or im.height != cell_size_y:
+            im = im.resize((cell_size_x, cell_size_y))
+        output_image.paste(im, (placement.cell_x * cell_size_x, (cells - 1 - placement.cell_y) * cell_size_y))
+    return output_image
+
+
+def generate_udim_texture(name: str, path: str, tiles: Dict[int, List[Tuple[TilePlacement, Optional[bpy.types.Image]]]]):
+    if len(tiles) == 1:
         raise Exception("No point in creating UDIMs with a single image, is there?")
-    if textures[0] is None:
+    tile_labels = {}
+    for udim, textures in tiles.items():
+        for placement, texture in textures:
+            if texture is None:
+                continue
+            if texture.is_dirty:
+                raise Exception("Texture has unsaved changes, please save first.")
+            if texture.filepath == "":
+                raise Exception("Texture not saved, cannot use for tiling.")
+        texture_names = [texture.name for placement, texture in textures if texture is not None]
+        tile_labels[udim] = "+".join(texture_names) if len(texture_names) > 0 else str(udim)
+
+    udims = sorted(tiles.keys())
+    first_texture = tiles[udims[0]][0][1]
+    if first_texture is None:
         texture_size_x = 1
         texture_size_y = 1
-        texture_name = "1001"
     else:
-        texture_size_x = textures[0].size[0]
-        texture_size_y = textures[0].size[1]
-        texture_name = textures[0].name
-    for texture in textures:
-        if texture is None:
-            continue
-        if texture.is_dirty:
-            raise Exception("Texture has unsaved changes, please save first.")
-        if texture.filepath == "":
-            raise Exception("Texture not saved, cannot use for tiling.")
+        texture_size_x = first_texture.size[0]
+        texture_size_y = first_texture.size[1]
 
     generated_image = bpy.data.images.new(name, texture_size_x, texture_size_y, alpha=True, tiled=True)
-    generated_image.tiles[0].label = texture_name
-    for tile_id in range(1, len(textures)):
-        tile_label = str(tile_id)
-        if textures[tile_id] is not None:
-            tile_label = textures[tile_id].name
-        generated_image.tiles.new(1001 + tile_id, label=tile_label)
+    generated_image.tiles[0].label = tile_labels[udims[0]]
+    for udim in udims[1:]:
+        generated_image.tiles.new(udim, label=tile_labels[udim])
 
     folder_path = bpy.path.abspath(path)
     try:
@@ -184,9 +257,16 @@ def generate_udim_texture(name: str, path: str, textures: List[bpy.types.Image])
     except FileExistsError:
         pass
 
-    for tile_id in range(0, len(textures)):
-        texture = textures[tile_id]
-        dest_path = os.path.join(folder_path, f"{name}.{1001 + tile_id}.png")
+    for udim in udims:
+        textures = tiles[udim]
+        dest_path = os.path.join(folder_path, f"{name}.{udim}.png")
+        placement, texture = textures[0]
+        if placement.cells > 1:
+            if all(x[1] is None for x in textures):
+                texture = None
+            else:
+                compose_tile(textures).save(dest_path, "PNG")
+                continue
         if texture is None:
             with open(dest_path, mode="wb") as dest_file:
                 # Single pixel PNG with #7F7FFF - couldn't be bothered to include it as a file.
@@ -204,13 +284,30 @@ def generate_udim_texture(name: str, path: str, textures: List[bpy.types.Image])
     return generated_image
 
 
-def main(target_materials: List[bpy.types.Material], directory: str, fileprefix: str):
+def has_unatlased_textures(mat: bpy.types.Material, definition: SimpleMaterialDefinition.SimpleMaterialDefinition):
+    # Shared tiles scale the whole UV map, so any other image texture in the material would sample the wrong region.
+    atlased = set()
+    for texture in [definition.diffuseTexture, definition.normalTexture, definition.metallicTexture]:
+        if texture is not None:
+            atlased.add(texture.name)
+    for node in mat.node_tree.nodes:
+        if node.type == "TEX_IMAGE" and node.image is not None and node.image.name not in atlased:
+            return True
+    return False
+
+
+def main(target_materials: List[bpy.types.Material], meshes: List[bpy.types.Mesh], directory: str, fileprefix: str,
+         layout: str = "GRID", share_tiles: bool = True):
     material_definitions = {}
+    exclusive_materials = set()
     for mat in target_materials:
         material_definitions[mat.name] = get_texture_set_for_material(mat)
+        if has_unatlased_textures(mat, material_definitions[mat.name]):
+            exclusive_materials.add(mat.name)
 
-    diffuse_udim_texture, normal_udim_texture, metallic_udim_texture = merge_textures_udim_style(material_definitions, bpy.data.meshes,
-                                                                          fileprefix, directory)
+    diffuse_udim_texture, normal_udim_texture, metallic_udim_texture = merge_textures_udim_style(material_definitions, meshes,
+                                                                          fileprefix, directory, layout, share_tiles,
+                                                                          exclusive_materials)
     for mat in material_definitions.values():
         mat.diffuseTexture.user_remap(diffuse_udim_texture)
         if mat.normalTexture is not None:
@@ -227,6 +324,17 @@ class AtlasOperator(bpy.types.Operator):
 
     directory: bpy.props.StringProperty(subtype="DIR_PATH")
     filename: bpy.props.StringProperty(subtype="FILE_NAME")
+    layout: bpy.props.EnumProperty(
+        name="Layout",
+        items=[
+            ("GRID", "Grid", "One material per UDIM tile, in selection order"),
+            ("SIZE", "Group by size", "Group materials by texture resolution, each group on its own UDIM rows"),
+        ],
+        default="GRID")
+    share_tiles: bpy.props.BoolProperty(
+        name="Share tiles",
+        description="Let smaller textures share a UDIM tile as a sub-grid when grouping by size",
+        default=True)
 
     def invoke(self, context, event):
         context.window_manager.fileselect_add(self)
@@ -247,5 +355,5 @@ class AtlasOperator(bpy.types.Operator):
             return {'CANCELLED'}
         prefix = filename_match.group(1)
 
-        main(materials, self.directory, prefix)
+        main(materials, context.blend_data.meshes, self.directory, prefix, self.layout, self.share_tiles)
         return {'FINISHED'}            # Lets Blender know the operator finished successfully.
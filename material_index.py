@@ -0,0 +1,75 @@
+from typing import List, Dict, Iterable
+import bpy
+import numpy as np
+
+
+class MeshMaterialLoops:
+    def __init__(self, mesh: bpy.types.Mesh, loops: Dict[str, np.ndarray]):
+        self.mesh = mesh
+        self.loops = loops
+
+
+class MaterialLoopIndex:
+    def __init__(self, entries: List[MeshMaterialLoops]):
+        self.entries = entries
+
+
+def expand_loop_ranges(loop_starts: np.ndarray, loop_totals: np.ndarray) -> np.ndarray:
+    # Turns (start, total) pairs into a flat array of every loop index in the ranges.
+    total = int(loop_totals.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    range_offsets = np.repeat(np.cumsum(loop_totals) - loop_totals, loop_totals)
+    return np.repeat(loop_starts, loop_totals) + (np.arange(total) - range_offsets)
+
+
+def build_material_loop_index(meshes: Iterable[bpy.types.Mesh], material_names: Iterable[str]) -> MaterialLoopIndex:
+    # Every mesh using a target material needs its UVs remapped, selected or not, since the materials themselves get
+    # changed. Meshes without a slot for one of them are skipped before any polygon data is read.
+    targets = set(material_names)
+    entries = []
+    for mesh in meshes:
+        # Material slots on the mesh that use one of the target materials
+        slots = {}
+        for slot_index, mat in enumerate(mesh.materials):
+            if mat is not None and mat.name in targets:
+                slots[slot_index] = mat.name
+        if len(slots) == 0:
+            continue
+
+        polygon_count = len(mesh.polygons)
+        material_indices = np.empty(polygon_count, dtype=np.int32)
+        loop_starts = np.empty(polygon_count, dtype=np.int32)
+        loop_totals = np.empty(polygon_count, dtype=np.int32)
+        mesh.polygons.foreach_get("material_index", material_indices)
+        mesh.polygons.foreach_get("loop_start", loop_starts)
+        mesh.polygons.foreach_get("loop_total", loop_totals)
+
+        loops = {}
+        for slot_index, material_name in slots.items():
+            mask = material_indices == slot_index
+            if not mask.any():
+                continue
+            slot_loops = expand_loop_ranges(loop_starts[mask], loop_totals[mask])
+            if material_name in loops:
+                # Same material in multiple slots
+                slot_loops = np.concatenate((loops[material_name], slot_loops))
+            loops[material_name] = slot_loops
+        if len(loops) == 0:
+            continue
+        entries.append(MeshMaterialLoops(mesh, loops))
+    return MaterialLoopIndex(entries)
+
+
+def read_uvs(mesh: bpy.types.Mesh) -> np.ndarray:
+    if len(mesh.uv_layers) == 0:
+        raise Exception("Missing UV map!")
+    uv_data = mesh.uv_layers[0].data
+    uvs = np.empty(len(uv_data) * 2, dtype=np.float32)
+    uv_data.foreach_get("uv", uvs)
+    return uvs.reshape((-1, 2))
+
+
+def write_uvs(mesh: bpy.types.Mesh, uvs: np.ndarray):
+    mesh.uv_layers[0].data.foreach_set("uv", uvs.reshape(-1))
+    mesh.update()
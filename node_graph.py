@@ -0,0 +1,118 @@
+from typing import List, Dict, Optional, Tuple
+import bpy
+
+
+# Surface node inputs that can carry a texture, and the socket names used for them across Blender versions.
+CHANNEL_INPUTS = {
+    "base_color": ["Base Color", "Color"],
+    "normal": ["Normal"],
+    "metallic": ["Metallic"],
+    "roughness": ["Roughness"],
+    "emission": ["Emission", "Emission Color"],
+    "alpha": ["Alpha"],
+}
+# Ambient occlusion isn't part of any BSDF, it's usually wired into a glTF settings group node next to the output.
+AO_INPUTS = ["Occlusion", "Ambient Occlusion", "AO"]
+
+# Nodes we follow upstream to find the image texture, and which input socket to follow.
+PASSTHROUGH_INPUTS = {
+    "NORMAL_MAP": "Color",
+    "REROUTE": "Input",
+    "RGBTOBW": "Color",
+    "SEPRGB": "Image",
+    "SEPARATE_COLOR": "Color",
+}
+
+
+class NodeGraphAnalysis:
+    def __init__(self):
+        self.output_node: Optional[bpy.types.Node] = None
+        self.surface_node: Optional[bpy.types.Node] = None
+        # (node name, input socket identifier) -> the link going into that socket
+        self.links_to: Dict[Tuple[str, str], bpy.types.NodeLink] = {}
+        # node name -> links going out of that node
+        self.links_from: Dict[str, List[bpy.types.NodeLink]] = {}
+        # channel -> socket found on the surface node, image texture feeding it, and nodes passed on the way there
+        self.sockets: Dict[str, bpy.types.NodeSocket] = {}
+        self.textures: Dict[str, Optional[bpy.types.Image]] = {}
+        self.paths: Dict[str, List[bpy.types.Node]] = {}
+
+    def link_to(self, node: bpy.types.Node, socket: bpy.types.NodeSocket) -> Optional[bpy.types.NodeLink]:
+        return self.links_to.get((node.name, socket.identifier))
+
+    def is_linked(self, channel: str):
+        return channel in self.paths
+
+    def is_output_linked(self, node: bpy.types.Node, socket: bpy.types.NodeSocket):
+        for link in self.links_from.get(node.name, []):
+            if link.from_socket.identifier == socket.identifier:
+                return True
+        return False
+
+
+def find_input(node: bpy.types.Node, names: List[str]) -> Optional[bpy.types.NodeSocket]:
+    for name in names:
+        socket = node.inputs.get(name)
+        if socket is not None and socket.enabled:
+            return socket
+    return None
+
+
+def trace_texture(analysis: NodeGraphAnalysis, link: bpy.types.NodeLink):
+    # Follow a link upstream through pass-through nodes until an image texture node, or something we don't know.
+    # A pass-through node with nothing connected upstream (e.g. a bare Normal Map node) has no texture, and ends
+    # the path on that pass-through node.
+    path = []
+    node = link.from_node
+    while True:
+        path.append(node)
+        if node.type == "TEX_IMAGE":
+            return node.image, path
+        if node.type not in PASSTHROUGH_INPUTS:
+            return None, path
+        socket = find_input(node, [PASSTHROUGH_INPUTS[node.type]])
+        if socket is None:
+            return None, path
+        upstream = analysis.link_to(node, socket)
+        if upstream is None:
+            return None, path
+        node = upstream.from_node
+
+
+def resolve_channel(analysis: NodeGraphAnalysis, channel: str, node: bpy.types.Node, names: List[str]):
+    socket = find_input(node, names)
+    if socket is None:
+        return
+    analysis.sockets[channel] = socket
+    link = analysis.link_to(node, socket)
+    if link is None:
+        return
+    analysis.textures[channel], analysis.paths[channel] = trace_texture(analysis, link)
+
+
+def analyze_node_tree(node_tree: bpy.types.NodeTree) -> NodeGraphAnalysis:
+    analysis = NodeGraphAnalysis()
+    for link in node_tree.links:
+        if not link.is_valid or link.is_muted:
+            continue
+        analysis.links_to[(link.to_node.name, link.to_socket.identifier)] = link
+        if link.from_node.name not in analysis.links_from:
+            analysis.links_from[link.from_node.name] = []
+        analysis.links_from[link.from_node.name].append(link)
+
+    ao_node = None
+    for node in node_tree.nodes:
+        if node.type == "OUTPUT_MATERIAL" and (analysis.output_node is None or node.is_active_output):
+            analysis.output_node = node
+        elif node.type == "GROUP" and ao_node is None and find_input(node, AO_INPUTS) is not None:
+            ao_node = node
+
+    if analysis.output_node is not None:
+        surface_link = analysis.link_to(analysis.output_node, analysis.output_node.inputs[0])
+        if surface_link is not None:
+            analysis.surface_node = surface_link.from_node
+            for channel, names in CHANNEL_INPUTS.items():
+                resolve_channel(analysis, channel, analysis.surface_node, names)
+    if ao_node is not None:
+        resolve_channel(analysis, "ao", ao_node, AO_INPUTS)
+    return analysis
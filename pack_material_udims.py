@@ -1,33 +1,36 @@
 from typing import List
 import bpy
 import os
-import math
+import numpy as np
 from .pack_udim import calc_pack_items, pack_udim_btree, PackCalculation
 from .atlas import get_texture_set_for_material
+from .material_index import build_material_loop_index, read_uvs, write_uvs
 from .NotifyUserException import NotifyUserException
 
 
-def map_uv(calc: PackCalculation, uv: List[float], tile_id: int):
+def map_uvs(calc: PackCalculation, uvs: np.ndarray):
     real_width = calc.packed_result.w
     real_height = calc.packed_result.h
 
-    u_transformed = math.fmod(uv[0], 1)
-    v_transformed = math.fmod(uv[1], 1)
+    tile_ids = 1001 + np.floor(uvs[:, 0]).astype(np.int64) + (np.floor(uvs[:, 1]).astype(np.int64) * 10)
+    transformed = np.fmod(uvs, 1)
+    mapped = np.empty_like(uvs)
 
-    tile_pack = None
-    for packed_item in calc.packed_result.items:
-        if packed_item.identity != f"{tile_id}":
-            continue
-        tile_pack = packed_item
-    if tile_pack is None:
-        raise NotifyUserException(f"Failed to find tile '{tile_id}'")
+    packed_items = {int(x.identity): x for x in calc.packed_result.items}
+    for tile_id in np.unique(tile_ids):
+        tile_pack = packed_items.get(int(tile_id))
+        if tile_pack is None:
+            raise NotifyUserException(f"Failed to find tile '{tile_id}'")
 
-    u_range = tile_pack.w / real_width
-    v_range = tile_pack.h / real_height
-    u_start = tile_pack.fit.x / real_width
-    v_start = 1 - (tile_pack.fit.y / real_height) - v_range
+        u_range = tile_pack.w / real_width
+        v_range = tile_pack.h / real_height
+        u_start = tile_pack.fit.x / real_width
+        v_start = 1 - (tile_pack.fit.y / real_height) - v_range
 
-    return [u_start + (u_transformed * u_range), v_start + (v_transformed * v_range)]
+        in_tile = tile_ids == tile_id
+        mapped[in_tile, 0] = u_start + (transformed[in_tile, 0] * u_range)
+        mapped[in_tile, 1] = v_start + (transformed[in_tile, 1] * v_range)
+    return mapped
 
 
 class AtlasUdimMaterialsOperator(bpy.types.Operator):
@@ -75,20 +78,12 @@ class AtlasUdimMaterialsOperator(bpy.types.Operator):
                     new_image.reload()
                     replacement_images[texture.name] = new_image
 
-        for mesh in bpy.data.meshes:
-            if len(mesh.materials) == 0:
-                continue  # Skip if no material slots exist on the mesh
-            if len(mesh.uv_layers) == 0:
-                raise Exception("Missing UV map!")
-            for polygon in mesh.polygons:
-                polygon_material_name = mesh.materials[polygon.material_index].name
-                if polygon_material_name not in material_calculations.keys():
-                    continue
-                for loop_index in polygon.loop_indices:
-                    loop_uv = mesh.uv_layers[0].data[loop_index].uv
-                    udim_id = math.floor(1000 + (math.floor(loop_uv[0]) + 1) + (math.floor(loop_uv[1]) * 10))
-                    mesh.uv_layers[0].data[loop_index].uv = map_uv(material_calculations[polygon_material_name],
-                                                                   loop_uv, udim_id)
+        loop_index = build_material_loop_index(context.blend_data.meshes, material_calculations.keys())
+        for entry in loop_index.entries:
+            uvs = read_uvs(entry.mesh)
+            for material_name, loops in entry.loops.items():
+                uvs[loops] = map_uvs(material_calculations[material_name], uvs[loops])
+            write_uvs(entry.mesh, uvs)
 
         for image_id in replacement_images.keys():
             bpy.data.images[image_id].user_remap(replacement_images[image_id])
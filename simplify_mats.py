@@ -2,12 +2,13 @@ from typing import List
 import bpy
 import json
 import hashlib
+from .node_graph import analyze_node_tree, NodeGraphAnalysis
 
 
-def hash_node(node: bpy.types.Node):
+def hash_node(analysis: NodeGraphAnalysis, node: bpy.types.Node):
     inputs = {}
     for inp in node.inputs:
-        if inp.is_linked:
+        if analysis.link_to(node, inp) is not None:
             inputs[inp.name] = "LINKED"
         else:
             try:
@@ -16,7 +17,7 @@ def hash_node(node: bpy.types.Node):
                 inputs[inp.name] = "UNKNOWN"
     outputs = {}
     for outp in node.outputs:
-        if outp.is_linked:
+        if analysis.is_output_linked(node, outp):
             outputs[outp.name] = "LINKED"
         else:
             try:
@@ -46,11 +47,12 @@ def hash_node_tree(node_tree: bpy.types.NodeTree):
     # * Node types in the tree
     # * Configuration of individual nodes
     # * Links between nodes
+    analysis = analyze_node_tree(node_tree)
     node_map = {}
     node_links = []
     for node in node_tree.nodes:
-        node_map[node.name] = hash_node(node)
-    for link in node_tree.links:
+        node_map[node.name] = hash_node(analysis, node)
+    for link in analysis.links_to.values():
         node_links.append(f"{node_map[link.from_node.name]}.{link.from_socket.name} - {node_map[link.to_node.name]}.{link.to_socket.name}")
     node_links.sort()
     node_list = [x for x in node_map.values()]